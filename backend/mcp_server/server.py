@@ -8,17 +8,37 @@ Token-based workflow with 6-step orchestration.
 Transport:
 - STDIO: Internal workers (default)
 - HTTP: External users via --http flag
+
+Catalog indexes (one-off, against a writable copy of programs.db before it is mounted read-only):
+    DB_PATH=/path/to/programs.db python server.py --ensure-indexes
 """
 import os
 import sys
+import asyncio
+import logging
 import sqlite3
+import time
+import threading
 import secrets
+import base64
+import hashlib
+import itertools
+import functools
 import json
+import uuid
+import zlib
 import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from collections import Counter, OrderedDict
+from contextlib import closing, contextmanager, suppress
 from pathlib import Path
-from typing import Optional, List, Any, Dict, Union
+from typing import Optional, List, Any, Dict, Union, NamedTuple, Tuple, FrozenSet
 from datetime import datetime
 from fastmcp import FastMCP
+from fastmcp.server.dependencies import get_http_headers
+
+logger = logging.getLogger(__name__)
 
 # Version
 __version__ = "1.2.0"
@@ -26,6 +46,26 @@ __version__ = "1.2.0"
 # Database path
 DB_PATH = os.getenv("DB_PATH", "/app/mcp/programs.db")
 
+# Optional SQLite file for sharing workflow tokens across processes and restarts (empty = memory only)
+TOKEN_DB_PATH = os.getenv("TOKEN_DB_PATH", "")
+
+# PostgreSQL connection settings (API keys, usage, consultation state)
+PG_CONNECT_KWARGS = {
+    "host": os.getenv("POSTGRES_HOST", "localhost"),
+    "port": os.getenv("POSTGRES_PORT", "5432"),
+    "dbname": os.getenv("POSTGRES_DB", "offeri"),
+    "user": os.getenv("POSTGRES_USER", "offeri_user"),
+    "password": os.getenv("POSTGRES_PASSWORD", "")
+}
+
+# Fallback API key when no Authorization header is present (stdio / SSE)
+SSE_API_KEY = os.getenv("SSE_API_KEY", "")
+
+# Upper bounds on client-submitted tool payloads (checked before parsing/validation)
+MAX_PAYLOAD_CHARS = int(os.getenv("MAX_PAYLOAD_CHARS", "2000000"))
+MAX_PAYLOAD_ITEMS = int(os.getenv("MAX_PAYLOAD_ITEMS", "10000"))
+MAX_PAYLOAD_DEPTH = int(os.getenv("MAX_PAYLOAD_DEPTH", "8"))
+
 # Classification mapping (15 categories)
 CLASSIFICATIONS = {
     1: "Health Sciences & Medicine",
@@ -44,9 +84,36 @@ CLASSIFICATIONS = {
     14: "Environment & Sustainability",
     15: "Interdisciplinary Studies"
 }
+VALID_CLASSIFICATION_NAMES = frozenset(CLASSIFICATIONS.values())
+
+# Classification list shown in select_classifications Call 1
+CLASSIFICATION_LIST = (
+    {"id": 1, "name": "Health Sciences & Medicine", "description": "Healthcare, nursing, public health, biomedical sciences"},
+    {"id": 2, "name": "Business & Management", "description": "Business administration, management, entrepreneurship, marketing"},
+    {"id": 3, "name": "Engineering", "description": "All engineering disciplines (mechanical, civil, electrical, etc.)"},
+    {"id": 4, "name": "Social Sciences", "description": "Psychology, sociology, anthropology, political science, international relations"},
+    {"id": 5, "name": "Education", "description": "Teaching, educational leadership, curriculum development"},
+    {"id": 6, "name": "Humanities & Languages", "description": "Literature, linguistics, history, philosophy, languages"},
+    {"id": 7, "name": "Arts Media & Design", "description": "Visual arts, performing arts, media, design, communication"},
+    {"id": 8, "name": "Computing & Data Science", "description": "Computer science, software engineering, data science, AI/ML"},
+    {"id": 9, "name": "Physical & Mathematical Sciences", "description": "Mathematics, statistics, physics, chemistry, astronomy"},
+    {"id": 10, "name": "Law & Public Policy", "description": "Law, legal studies, public administration, policy analysis"},
+    {"id": 11, "name": "Life Sciences", "description": "Biology, biotechnology, genetics, neuroscience, biochemistry"},
+    {"id": 12, "name": "Finance & Economics", "description": "Finance, economics, accounting, financial engineering"},
+    {"id": 13, "name": "Architecture & Planning", "description": "Architecture, urban planning, landscape architecture"},
+    {"id": 14, "name": "Environment & Sustainability", "description": "Environmental science, sustainability, conservation, climate"},
+    {"id": 15, "name": "Interdisciplinary Studies", "description": "Cross-disciplinary programs, liberal studies, general research"}
+)
+
+# Application mix per strategy (lottery/reach/target/safety)
+STRATEGY_RATIOS = {
+    "conservative": {"lottery": "10%", "reach": "30%", "target": "40%", "safety": "20%"},
+    "aggressive": {"lottery": "20%", "reach": "50%", "target": "20%", "safety": "10%"}
+}
 
-# In-memory token store (for validation)
-_active_tokens = {}
+# Fields every program analysis must provide (generate_final_report)
+REQUIRED_ANALYSIS_FIELDS = ("program_features", "student_experience", "suitability_analysis")
+REQUIRED_ANALYSIS_FIELD_SET = frozenset(REQUIRED_ANALYSIS_FIELDS)
 
 # Initialize FastMCP server
 mcp = FastMCP(
@@ -67,43 +134,358 @@ mcp = FastMCP(
 )
 
 
+# ═══════════════════════════════════════════════════════════════
+# IN-PROCESS CACHES
+# ═══════════════════════════════════════════════════════════════
+
+class _TTLCache:
+    """Bounded, thread-safe mapping whose entries expire a fixed number of seconds after insertion"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            with self._lock:
+                if self._data.get(key) is entry:
+                    del self._data[key]
+            return default
+        return value
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.set(key, value)
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        """Insert with the default TTL, or a shorter one for entries that are already aging"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)  # Evict oldest insertion
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# api_key -> (tier, allowed_tools) for active keys; revocations take effect within the TTL
+_api_key_tier_cache = _TTLCache(maxsize=4096, ttl=60)
+
+# Usage tracking buffer: api_key -> calls since the last flush (event loop thread only)
+USAGE_FLUSH_INTERVAL = 1.0
+USAGE_FLUSH_MAX_KEYS = 500
+USAGE_PENDING_MAX_KEYS = 10_000  # Buffer cap while PostgreSQL is unreachable; calls beyond it are dropped
+_pending_usage: Counter = Counter()
+_usage_calls_dropped = 0  # Calls that could not be recorded (buffer full or a non-retryable flush error)
+_usage_drops_reported = 0
+_usage_flush_now = asyncio.Event()
+_usage_flusher_task: Optional[asyncio.Task] = None
+
+class _CircuitBreaker:
+    """Skips work for `cooldown` seconds after `threshold` consecutive connection failures"""
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._open_until = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+    def record_failure(self, error: Exception) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self._open_until = time.monotonic() + self.cooldown
+            self.failures = 0
+            logger.warning(f"{self.name}: {error} (pausing for {self.cooldown:.0f}s)")
+        elif self.failures == 1:
+            logger.warning(f"{self.name}: {error}")
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+
+# Stops usage flushes from hammering PostgreSQL while it is down
+_usage_breaker = _CircuitBreaker("usage tracking", threshold=5, cooldown=30)
+
+# API keys the last flush could not attribute to a user; skipped until the entry expires
+_untracked_key_cache = _TTLCache(maxsize=10_000, ttl=60)
+
+# get_database_statistics aggregates: the catalog changes on the order of hours
+_stats_cache = _TTLCache(maxsize=1, ttl=600)
+
+
 # ═══════════════════════════════════════════════════════════════
 # TOKEN MANAGEMENT
 # ═══════════════════════════════════════════════════════════════
 
-def generate_token(token_type: str, data: dict) -> str:
+class TokenEntry(NamedTuple):
+    """Stored workflow token: step type, embedded data, creation time (time.monotonic())"""
+    type: str
+    data: dict
+    created: float
+
+
+# Token store limits: bounded memory regardless of uptime or traffic
+MAX_ACTIVE_TOKENS = 10_000
+TOKEN_TTL_SECONDS = 3600
+
+# In-memory token store (for validation); expired or evicted tokens read as invalid
+_active_tokens = _TTLCache(maxsize=MAX_ACTIVE_TOKENS, ttl=TOKEN_TTL_SECONDS)
+
+# Token derivation: one CSPRNG draw per process, then keyed BLAKE2b (a MAC) over a counter
+_TOKEN_KEY = secrets.token_bytes(32)
+_token_counter = itertools.count()
+
+async def generate_token(token_type: str, data: dict) -> str:
     """Generate a secure token with embedded data"""
-    token = f"{token_type}_{secrets.token_urlsafe(16)}"
-    _active_tokens[token] = {
-        "type": token_type,
-        "data": data,
-        "created_at": datetime.utcnow().isoformat()
-    }
+    digest = hashlib.blake2b(
+        next(_token_counter).to_bytes(8, "big"),
+        key=_TOKEN_KEY,
+        digest_size=12  # 96 bits: unguessable, and a multiple of 3 bytes encodes without '=' padding
+    ).digest()
+    token = f"{token_type}_{base64.urlsafe_b64encode(digest).decode()}"
+    entry = TokenEntry(token_type, data, time.monotonic())
+    _active_tokens[token] = entry
+    if TOKEN_DB_PATH:
+        await asyncio.to_thread(_persist_token, token, entry)  # SQLite may wait on other writers
     return token
 
-def validate_token(token: str, expected_type: str) -> dict:
+async def lookup_token(token: str) -> Optional[TokenEntry]:
+    """Find a live token in memory, falling back to the shared token database if configured"""
+    if not token:
+        return None
+    entry = _active_tokens.get(token)
+    if entry is None and TOKEN_DB_PATH:
+        entry = await asyncio.to_thread(_load_persisted_token, token)
+    return entry
+
+async def validate_token(token: str, expected_type: str) -> dict:
     """Validate token and return embedded data"""
-    if not token or token not in _active_tokens:
+    token_data = await lookup_token(token)
+    if token_data is None:
         raise ValueError(f"Invalid or expired token. Did you call the previous step?")
     
-    token_data = _active_tokens[token]
-    if token_data["type"] != expected_type:
-        raise ValueError(f"Wrong token type. Expected {expected_type}, got {token_data['type']}")
+    if token_data.type != expected_type:
+        raise ValueError(f"Wrong token type. Expected {expected_type}, got {token_data.type}")
     
-    return token_data["data"]
+    return token_data.data
+
+
+# Optional shared token store: lets workflows survive restarts and span worker processes.
+# Memory stays the fast path; SQLite is written through and read only on a memory miss,
+# both in worker threads so a busy database never blocks the event loop.
+_token_db_local = threading.local()
+_token_sweep_counter = itertools.count(1)
+TOKEN_SWEEP_EVERY = 256  # Delete expired rows once per this many new tokens
+TOKEN_COMPRESS_MIN_BYTES = 4096  # Larger payloads (cumulative program lists) are stored zlib-compressed
+
+def _get_token_db() -> sqlite3.Connection:
+    """Internal: This thread's connection to the token database (created on first use)"""
+    conn = getattr(_token_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(TOKEN_DB_PATH, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                token TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                data_json TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        _token_db_local.conn = conn
+    return conn
+
+def _persist_token(token: str, entry: TokenEntry) -> None:
+    """Internal: Write a new token through to the token database"""
+    now = time.time()
+    data_json: Union[str, bytes] = json.dumps(entry.data, separators=(",", ":"))
+    if len(data_json) >= TOKEN_COMPRESS_MIN_BYTES:
+        data_json = zlib.compress(data_json.encode(), 3)  # Stored as a BLOB
+    try:
+        conn = _get_token_db()
+        conn.execute(
+            "INSERT OR REPLACE INTO tokens (token, type, data_json, created_at) VALUES (?, ?, ?, ?)",
+            (token, entry.type, data_json, now)
+        )
+        if next(_token_sweep_counter) % TOKEN_SWEEP_EVERY == 0:
+            conn.execute("DELETE FROM tokens WHERE created_at < ?", (now - TOKEN_TTL_SECONDS,))
+    except sqlite3.Error as e:
+        logger.warning(f"Token persistence failed ({TOKEN_DB_PATH}): {e}")
+
+def _load_persisted_token(token: str) -> Optional[TokenEntry]:
+    """Internal: Load an unexpired token issued by another process (or before a restart)"""
+    try:
+        row = _get_token_db().execute(
+            "SELECT type, data_json, created_at FROM tokens WHERE token = ? AND created_at >= ?",
+            (token, time.time() - TOKEN_TTL_SECONDS)
+        ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Token lookup failed ({TOKEN_DB_PATH}): {e}")
+        return None
+    if row is None:
+        return None
+
+    token_type, data_json, created_at = row
+    try:
+        if isinstance(data_json, bytes):
+            data_json = zlib.decompress(data_json)
+        data = json.loads(data_json)
+    except (zlib.error, ValueError) as e:
+        logger.warning(f"Ignoring corrupt token row ({TOKEN_DB_PATH}): {e}")
+        return None
+    age = time.time() - created_at
+    entry = TokenEntry(token_type, data, time.monotonic() - age)
+    _active_tokens.set(token, entry, ttl=TOKEN_TTL_SECONDS - age)  # Keep the original expiry
+    return entry
+
+
+# Idempotency: responses of token-issuing steps, keyed by a hash of the call arguments
+_tool_responses = _TTLCache(maxsize=1024, ttl=600)
+
+def _request_key(tool_name: str, *args: Any) -> str:
+    """Internal: Idempotency key for a tool call (hash of its canonical JSON arguments)"""
+    payload = json.dumps([tool_name, *args], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+def _remember_response(request_key: str, response: dict) -> dict:
+    """Internal: Store a tool response for identical retries and return it"""
+    _tool_responses[request_key] = response
+    return response
 
 
 # ═══════════════════════════════════════════════════════════════
 # DATABASE HELPERS (Internal - not exposed as tools)
 # ═══════════════════════════════════════════════════════════════
 
+# Catalog file version: memoized lookups and open connections belong to one st_mtime
+_catalog_mtime: Optional[int] = None
+_catalog_generation = 0
+_catalog_caches: List[Any] = []
+
+def _check_catalog_mtime() -> None:
+    """Internal: Drop memoized catalog lookups and connections if programs.db was replaced"""
+    global _catalog_mtime, _catalog_generation
+    try:
+        mtime = os.stat(DB_PATH).st_mtime_ns
+    except OSError:
+        return
+    if mtime == _catalog_mtime:
+        return
+    if _catalog_mtime is not None:
+        for cached in _catalog_caches:
+            cached.cache_clear()
+        _stats_cache.pop("stats")
+        _catalog_generation += 1  # Threads reopen their connections on next use
+    _catalog_mtime = mtime
+
+def _catalog_cache(maxsize: int):
+    """Internal: functools.lru_cache that is cleared whenever the catalog file changes"""
+    def decorator(func):
+        cached = functools.lru_cache(maxsize=maxsize)(func)
+        _catalog_caches.append(cached)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            _check_catalog_mtime()
+            return cached(*args)
+
+        wrapper.cache_clear = cached.cache_clear
+        return wrapper
+    return decorator
+
+
+# One cached read-only connection per thread (reused across tool calls)
+_db_local = threading.local()
+
 def get_db_connection():
-    """Create database connection"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Get this thread's read-only database connection tuned for the static programs catalog.
+
+    The connection is cached and must not be closed by callers; close cursors instead.
+    It is reopened automatically after the catalog file changes.
+    """
+    _check_catalog_mtime()
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and _db_local.generation != _catalog_generation:
+        conn.close()
+        conn = None
+    if conn is None:
+        # as_uri() percent-encodes the path, so '?', '#' and '%' in DB_PATH stay literal
+        conn = sqlite3.connect(
+            Path(DB_PATH).resolve().as_uri() + "?mode=ro",
+            uri=True, check_same_thread=False, cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=1")
+        conn.execute("PRAGMA cache_size=-131072")   # 128 MB page cache
+        conn.execute("PRAGMA mmap_size=1073741824")  # Map up to 1 GB of the file
+        conn.execute("PRAGMA temp_store=MEMORY")     # GROUP BY / ORDER BY temp b-trees in RAM
+        _db_local.conn = conn
+        _db_local.generation = _catalog_generation
     return conn
 
 
+class _PgConnection(psycopg2.extensions.connection):
+    """Pooled connection that remembers which server-side prepared statements it holds"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+
+
+# Shared PostgreSQL pool, created on first use so imports work without a database
+_pg_pool: Optional[ThreadedConnectionPool] = None
+_pg_pool_lock = threading.Lock()
+
+def _get_pg_pool() -> ThreadedConnectionPool:
+    """Get the process-wide PostgreSQL connection pool"""
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                _pg_pool = ThreadedConnectionPool(
+                    minconn=1,
+                    maxconn=16,
+                    connection_factory=_PgConnection,
+                    **PG_CONNECT_KWARGS
+                )
+    return _pg_pool
+
+
+@contextmanager
+def _pg_connection(autocommit: bool = False):
+    """Borrow a pooled PostgreSQL connection; uncommitted work is rolled back on return"""
+    pool = _get_pg_pool()
+    conn = pool.getconn()
+    discard = False
+    try:
+        if conn.autocommit != autocommit:
+            conn.autocommit = autocommit
+        yield conn
+    finally:
+        try:
+            conn.rollback()  # No-op after commit; ends read-only transactions
+        except psycopg2.Error:
+            discard = True
+        pool.putconn(conn, close=discard or bool(conn.closed))
+
+
 def validate_api_key_and_tool(tool_name: str) -> tuple:
     """
     Validate API key and check tool permission based on tier.
@@ -120,8 +502,6 @@ def validate_api_key_and_tool(tool_name: str) -> tuple:
     Raises:
         ValueError: If API key is invalid, inactive, or lacks permission
     """
-    from fastmcp.server.dependencies import get_http_headers
-
     # Extract API key from Authorization header or environment
     api_key = ""
     try:
@@ -134,209 +514,375 @@ def validate_api_key_and_tool(tool_name: str) -> tuple:
 
     # Fallback to environment variable if no API key from headers
     if not api_key:
-        api_key = os.getenv("SSE_API_KEY", "")
+        api_key = SSE_API_KEY
 
     if not api_key or not api_key.startswith("sk_"):
         raise ValueError("Invalid or missing API key. Please provide a valid API key in Authorization header.")
 
-    # Query PostgreSQL for tier and allowed_tools
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432"),
-            dbname=os.getenv("POSTGRES_DB", "offeri"),
-            user=os.getenv("POSTGRES_USER", "offeri_user"),
-            password=os.getenv("POSTGRES_PASSWORD", "")
-        )
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT tier, allowed_tools, is_active
-            FROM api_keys
-            WHERE id = %s
-        """, (api_key,))
-        result = cursor.fetchone()
+    # Query PostgreSQL for tier and allowed_tools (active keys are cached briefly)
+    cached = _api_key_tier_cache.get(api_key)
+    if cached is None:
+        try:
+            with _pg_connection() as conn, conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT tier, allowed_tools, is_active
+                    FROM api_keys
+                    WHERE id = %s
+                """, (api_key,))
+                result = cursor.fetchone()
+        except Exception as e:
+            raise ValueError(f"API key validation failed (database error): {e}")
 
         if not result:
-            conn.close()
             raise ValueError(f"API key not found or invalid: {api_key[:20]}...")
 
         tier, allowed_tools, is_active = result
 
         if not is_active:
-            conn.close()
             raise ValueError(f"API key has been revoked. Please generate a new key at https://offeri.org/dashboard")
 
-        # Validate tool permission
-        if tool_name not in allowed_tools:
-            conn.close()
-            # Show first 5 tools to avoid overwhelming user
-            available_tools = ', '.join(allowed_tools[:5])
-            if len(allowed_tools) > 5:
-                available_tools += f" (and {len(allowed_tools) - 5} more)"
-            raise ValueError(
-                f"Access denied: {tool_name}\n"
-                f"Your tier '{tier}' only has access to: {available_tools}"
-            )
+        cached = (tier, allowed_tools)
+        _api_key_tier_cache[api_key] = cached
 
-        conn.close()
-        return (tier, allowed_tools)
+    tier, allowed_tools = cached
 
-    except ValueError:
-        raise
-    except Exception as e:
-        raise ValueError(f"API key validation failed (database error): {e}")
+    # Validate tool permission
+    if tool_name not in allowed_tools:
+        # Show first 5 tools to avoid overwhelming user
+        available_tools = ', '.join(allowed_tools[:5])
+        if len(allowed_tools) > 5:
+            available_tools += f" (and {len(allowed_tools) - 5} more)"
+        raise ValueError(
+            f"Access denied: {tool_name}\n"
+            f"Your tier '{tier}' only has access to: {available_tools}"
+        )
 
+    return (tier, allowed_tools)
 
-def clean_null_values(data: Any) -> Any:
-    """Remove null, empty, N/A values"""
-    if isinstance(data, dict):
-        return {
-            k: clean_null_values(v)
-            for k, v in data.items()
-            if v is not None
-            and v != ''
-            and v != 'N/A'
-            and v != 'null'
-            and not (isinstance(v, (list, dict)) and not v)
-        }
-    elif isinstance(data, list):
-        return [clean_null_values(item) for item in data if item is not None]
-    return data
-
-def _list_universities(country: str) -> List[str]:
-    """Internal: Get all universities in a country"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT university_name
-        FROM programs
-        WHERE country_standardized = ?
-        GROUP BY university_name
-        ORDER BY COUNT(*) DESC
-    """, [country])
-    results = cursor.fetchall()
-    conn.close()
-    
-    return [row["university_name"] for row in results]
 
-def _get_available_countries() -> List[Dict[str, Any]]:
-    """Internal: Get all countries with program counts"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT country_standardized, COUNT(*) as count
-        FROM programs
-        WHERE country_standardized IS NOT NULL
-        GROUP BY country_standardized
-        ORDER BY count DESC
-    """)
-    results = cursor.fetchall()
-    conn.close()
-    
-    return [{"country": row["country_standardized"], "count": row["count"]} for row in results]
+# Scalar values treated as "no data" (dropped from catalog rows)
+_EMPTY_VALUES = frozenset({None, '', 'N/A', 'null'})
 
-def _get_classifications_for_universities(university_names: List[str]) -> Dict[str, int]:
-    """Internal: Get all unique classifications from multiple universities with program counts"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _assert_payload_limits(name: str, payload: Any) -> None:
+    """Internal: Reject oversized or overly nested tool arguments before any O(N) work.
 
-    placeholders = ','.join('?' * len(university_names))
-    patterns = [f"%{uni}%" for uni in university_names]
+    Raw JSON strings are only length-checked here (before json.loads); callers
+    check again once parsed. Dicts/lists are walked iteratively, counting
+    keys/items and string length.
+    """
+    if isinstance(payload, str):
+        if len(payload) > MAX_PAYLOAD_CHARS:
+            raise ValueError(f"{name} is too large: over {MAX_PAYLOAD_CHARS} characters")
+        return
+
+    items = chars = 0
+    stack = [(payload, 1)]
+    while stack:
+        node, depth = stack.pop()
+        if isinstance(node, dict):
+            values = node.values()
+            chars += sum(len(k) for k in node if isinstance(k, str))
+        elif isinstance(node, list):
+            values = node
+        else:
+            continue
+        if depth > MAX_PAYLOAD_DEPTH:
+            raise ValueError(f"{name} is nested too deeply: over {MAX_PAYLOAD_DEPTH} levels")
+        items += len(node)
+        if items > MAX_PAYLOAD_ITEMS:
+            raise ValueError(f"{name} is too large: over {MAX_PAYLOAD_ITEMS} keys/items")
+        for v in values:
+            if isinstance(v, str):
+                chars += len(v)
+            elif isinstance(v, (dict, list)):
+                stack.append((v, depth + 1))
+        if chars > MAX_PAYLOAD_CHARS:
+            raise ValueError(f"{name} is too large: over {MAX_PAYLOAD_CHARS} characters")
+
+# Indexes the hot query shapes rely on (built by --ensure-indexes, checked at startup)
+_CATALOG_INDEXES = ("idx_programs_country_uni", "idx_programs_university")
+
+def _ensure_indexes() -> bool:
+    """Create indexes for the hot query shapes (one-off migration: `server.py --ensure-indexes`).
+
+    The deployed catalog is mounted read-only, so this runs against a writable
+    copy before it ships. Opens the existing file only (mode=rw): a wrong
+    DB_PATH fails instead of leaving an empty database behind.
+    """
+    try:
+        conn = sqlite3.connect(Path(DB_PATH).resolve().as_uri() + "?mode=rw", uri=True)
+        try:
+            # Covering index for the (country, university) GROUP BY in _universities_by_country
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_programs_country_uni
+                ON programs(country_standardized, university_name)
+            """)
+            # Exact-name program lookups in _search_programs
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_programs_university ON programs(university_name)")
+            # program_id lookups should hit the rowid b-tree; index it only if it is not the primary key
+            pk_columns = [row[1] for row in conn.execute("PRAGMA table_info(programs)") if row[5]]
+            if pk_columns != ["program_id"]:
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_programs_id ON programs(program_id)")
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.OperationalError as e:
+        logger.error(f"Index creation on {DB_PATH} failed: {e}")
+        return False
+    return True
 
-    cursor.execute(f"""
-        SELECT classification, COUNT(*) as count
-        FROM programs
-        WHERE ({' OR '.join(['LOWER(university_name) LIKE LOWER(?)' for _ in university_names])})
-        AND classification IS NOT NULL
-        GROUP BY classification
-        ORDER BY count DESC
-    """, patterns)
-    results = cursor.fetchall()
-    conn.close()
+def _check_catalog_indexes() -> None:
+    """Internal: Warn at startup if the catalog ships without the indexes its queries expect"""
+    try:
+        with closing(get_db_connection().cursor()) as cursor:
+            cursor.row_factory = None
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+            present = {name for (name,) in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logger.warning(f"Skipping catalog index check: {e}")
+        return
+    missing = [name for name in _CATALOG_INDEXES if name not in present]
+    if missing:
+        logger.warning(
+            f"Catalog {DB_PATH} is missing indexes {missing}; university lookups will scan the table. "
+            f"Run `server.py --ensure-indexes` against a writable copy of the catalog."
+        )
 
-    return {row["classification"]: row["count"] for row in results}
+# Fixed-shape queries: identical SQL text on every call hits sqlite3's per-connection statement cache
+# Every country's universities in one pass, each country's list by program count (desc)
+_UNIVERSITIES_BY_COUNTRY_SQL = """
+    SELECT country_standardized, university_name
+    FROM programs
+    WHERE country_standardized IS NOT NULL
+    GROUP BY country_standardized, university_name
+    ORDER BY country_standardized, COUNT(*) DESC, university_name
+"""
 
-def _search_programs(university_name: str, classification_filters: Optional[List[str]] = None) -> List[Dict[str, Any]]:
-    """Internal: Get programs for a university, optionally filtered by classifications (OR logic for primary and secondary)"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = """
-        SELECT program_id, program_name, degree_type
-        FROM programs
-        WHERE LOWER(university_name) LIKE LOWER(?)
-    """
-    params = [f"%{university_name}%"]
+_AVAILABLE_COUNTRIES_SQL = """
+    SELECT country_standardized, COUNT(*) as count
+    FROM programs
+    WHERE country_standardized IS NOT NULL
+    GROUP BY country_standardized
+    ORDER BY count DESC
+"""
+
+# All three statistics in one statement, assembled as JSON by SQLite
+_DATABASE_STATISTICS_SQL = """
+    SELECT json_object(
+        'total_programs', (SELECT COUNT(*) FROM programs),
+        'top_countries', (
+            SELECT json_group_array(json_object('country', country, 'count', count))
+            FROM (
+                SELECT country_standardized as country, COUNT(*) as count
+                FROM programs
+                WHERE country_standardized IS NOT NULL
+                GROUP BY country_standardized
+                ORDER BY count DESC
+                LIMIT 10
+            )
+        ),
+        'degree_types', (
+            SELECT json_group_array(json_object('degree_type', degree_type, 'count', count))
+            FROM (
+                SELECT degree_type, COUNT(*) as count
+                FROM programs
+                WHERE degree_type IS NOT NULL
+                GROUP BY degree_type
+                ORDER BY count DESC
+            )
+        )
+    ) AS payload
+"""
+
+# List parameters are bound as one JSON array via json_each(?), so the SQL text never varies
+_SEARCH_PROGRAMS_SQL = """
+    SELECT program_id, program_name, degree_type
+    FROM programs
+    WHERE university_name = ?
+    ORDER BY program_name
+"""
+
+_SEARCH_PROGRAMS_FILTERED_SQL = """
+    SELECT program_id, program_name, degree_type
+    FROM programs
+    WHERE university_name = ?
+    AND (classification IN (SELECT value FROM json_each(?))
+         OR secondary_classification IN (SELECT value FROM json_each(?)))
+    ORDER BY program_name
+"""
 
-    if classification_filters:
-        # OR logic: match if EITHER classification OR secondary_classification matches
-        placeholders = ','.join('?' * len(classification_filters))
-        query += f" AND (classification IN ({placeholders}) OR secondary_classification IN ({placeholders}))"
-        params.extend(classification_filters)
-        params.extend(classification_filters)  # Add filters twice for both conditions
+# Rows come back in the order of the bound ID list (first occurrence wins for duplicates)
+_PROGRAM_DETAILS_SQL = """
+    SELECT p.program_id, p.program_name, p.university_name,
+           p.country_standardized, p.city, p.degree_type,
+           p.duration_months, p.classification,
+           CASE WHEN INSTR(LOWER(p.study_mode), 'part') > 0 THEN 1 END AS is_part_time
+    FROM (
+        SELECT CAST(value AS INTEGER) AS pid, MIN(key) AS pos
+        FROM json_each(?)
+        GROUP BY pid
+    ) AS ids
+    JOIN programs p ON p.program_id = ids.pid
+    ORDER BY ids.pos
+"""
 
-    query += " ORDER BY program_name"
+@_catalog_cache(maxsize=1)
+def _universities_by_country() -> Dict[str, Tuple[str, ...]]:
+    """Internal: country -> universities ordered by program count (loaded once per catalog file)"""
+    with closing(get_db_connection().cursor()) as cursor:
+        cursor.row_factory = None  # Plain (country, university) tuples
+        cursor.execute(_UNIVERSITIES_BY_COUNTRY_SQL)
+        results = cursor.fetchall()
+
+    grouped: Dict[str, List[str]] = {}
+    for country, university in results:
+        grouped.setdefault(country, []).append(university)
+    return {country: tuple(universities) for country, universities in grouped.items()}
+
+def _list_universities(country: str) -> Tuple[str, ...]:
+    """Internal: Get all universities in a country (served from the startup-loaded map)"""
+    return _universities_by_country().get(country, ())
+
+@_catalog_cache(maxsize=256)
+def _known_universities(country: str) -> FrozenSet[str]:
+    """Internal: Universities in a country as a set, for O(1) selection checks"""
+    return frozenset(_list_universities(country))
+
+@_catalog_cache(maxsize=1)
+def _get_available_countries() -> Tuple[Dict[str, Any], ...]:
+    """Internal: Get all countries with program counts (memoized until the catalog file changes)"""
+    with closing(get_db_connection().cursor()) as cursor:
+        cursor.row_factory = None  # Plain (country, count) tuples
+        cursor.execute(_AVAILABLE_COUNTRIES_SQL)
+        results = cursor.fetchall()
+
+    return tuple({"country": country, "count": count} for country, count in results)
+
+@_catalog_cache(maxsize=1)
+def _get_top_countries_suggestion() -> str:
+    """Internal: Top 10 countries by program count for unknown-country errors, formatted once and reused"""
+    return ", ".join(f"{c['country']} ({c['count']})" for c in _get_available_countries()[:10])
+
+@_catalog_cache(maxsize=1)
+def _get_available_countries_text() -> str:
+    """Internal: get_available_countries response, formatted once and reused"""
+    return "\n".join(f"{c['country']} ({c['count']} programs)" for c in _get_available_countries())
+
+def _warm_catalog_caches() -> None:
+    """Precompute static catalog lookups at startup so error paths never touch the database"""
+    try:
+        _universities_by_country()
+        _get_top_countries_suggestion()
+        _get_available_countries_text()
+    except sqlite3.Error as e:
+        logger.warning(f"Skipping catalog cache warm-up: {e}")
 
-    cursor.execute(query, params)
-    results = cursor.fetchall()
-    conn.close()
+def _search_programs(university_name: str, classification_filters: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Internal: Get programs for a university, optionally filtered by classifications (OR logic for primary and secondary).
+
+    university_name must be an exact name as returned by _list_universities.
+    """
+    # Filters are OR-ed, so order and duplicates don't matter for the cache key
+    return list(_search_programs_cached(university_name, tuple(sorted(set(classification_filters or ())))))
+
+@_catalog_cache(maxsize=1024)
+def _search_programs_cached(university_name: str, classification_filters: Tuple[str, ...]) -> Tuple[Dict[str, Any], ...]:
+    """Internal: Memoized program search (until the catalog file changes); see _search_programs"""
+    with closing(get_db_connection().cursor()) as cursor:
+        if classification_filters:
+            # OR logic: match if EITHER classification OR secondary_classification matches
+            filters_json = json.dumps(classification_filters)
+            cursor.execute(_SEARCH_PROGRAMS_FILTERED_SQL, (university_name, filters_json, filters_json))
+        else:
+            cursor.execute(_SEARCH_PROGRAMS_SQL, (university_name,))
+        results = cursor.fetchall()
 
-    return [{
+    return tuple({
         "id": row["program_id"],
         "name": row["program_name"],
         "degree": row["degree_type"]
-    } for row in results]
+    } for row in results)
 
 def _get_program_details_batch(program_ids: List[int]) -> List[dict]:
     """Internal: Get essential details for multiple programs"""
     if not program_ids:
         return []
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    placeholders = ','.join('?' * len(program_ids))
-    query = f"""
-        SELECT program_id, program_name, university_name,
-               country_standardized, city, degree_type,
-               duration_months, study_mode, classification
-        FROM programs
-        WHERE program_id IN ({placeholders})
-    """
-
-    cursor.execute(query, program_ids)
-    results = cursor.fetchall()
-    conn.close()
+    with closing(get_db_connection().cursor()) as cursor:
+        cursor.execute(_PROGRAM_DETAILS_SQL, (json.dumps(program_ids),))
+        columns = [col[0] for col in cursor.description]
+        results = cursor.fetchall()
 
+    # Rows hold only scalars, so empty values are dropped while building.
+    # is_part_time is 1 for part-time programs and NULL otherwise.
     programs = []
     for row in results:
-        program = {
-            "program_id": row["program_id"],
-            "program_name": row["program_name"],
-            "university_name": row["university_name"],
-            "country_standardized": row["country_standardized"],
-            "city": row["city"],
-            "degree_type": row["degree_type"],
-            "duration_months": row["duration_months"],
-            "classification": row["classification"]
-        }
-
-        study_mode = row["study_mode"]
-        if study_mode and "part" in study_mode.lower():
+        program = {k: v for k, v in zip(columns, row) if v not in _EMPTY_VALUES}
+        if "is_part_time" in program:
             program["is_part_time"] = True
-
         programs.append(program)
 
-    return [clean_null_values(p) for p in programs]
+    return programs
 
 
 # ═══════════════════════════════════════════════════════════════
 # WORKFLOW ORCHESTRATION TOOLS
 # ═══════════════════════════════════════════════════════════════
 
+@_catalog_cache(maxsize=256)
+def _university_selection_instructions(country: str, strategy: str) -> str:
+    """Internal: start_and_select_universities Call 1 instructions, rendered once per (country, strategy)"""
+    all_universities = _list_universities(country)
+    ratios = STRATEGY_RATIOS[strategy]
+    return f"""
+COUNTRY: {country}
+TOTAL UNIVERSITIES: {len(all_universities)}
+STRATEGY: {strategy.upper()}
+
+All universities in {country}:
+{chr(10).join(f"  • {uni}" for uni in all_universities)}
+
+YOUR TASK: Select universities matching student's profile (max 14)
+
+SELECTION STRATEGY ({strategy.capitalize()}):
+1. Analyze student profile (GPA, background, goals)
+
+2. Build portfolio across difficulty levels:
+   - Lottery: {ratios['lottery']} (Dream schools, extremely competitive)
+   - Reach: {ratios['reach']} (Highly competitive, student slightly below average)
+   - Target: {ratios['target']} (Competitive match, student fits typical profile)
+   - Safety: {ratios['safety']} (Strong admission likelihood, student above average)
+
+3. Optional: 0-3 web searches if uncertain about specific universities
+
+NEXT STEP:
+Call start_and_select_universities() AGAIN with:
+- Same background, country, strategy
+- selected_universities: [chosen university names]
+- optional_web_searches: [...] (if needed)
+            """
+
+
+# select_classifications Call 1 instructions (static: the classification list never changes)
+_CLASSIFICATION_SELECTION_INSTRUCTIONS = f"""
+ALL 15 CLASSIFICATION CATEGORIES
+
+{chr(10).join(f"  {c['id']:2d}. {c['name']:40s} - {c['description']}" for c in CLASSIFICATION_LIST)}
+
+YOUR TASK: Select relevant classifications based on student background
+
+SELECTION STRATEGY:
+1. PRIMARY: Direct match with student's major/field/career goals
+2. SECONDARY: Related/complementary fields student might consider
+3. Be inclusive but sensible - avoid obviously irrelevant fields
+
+NEXT STEP:
+Call select_classifications() AGAIN with:
+- Same selection_token
+- selected_classifications: [list of chosen classification names]
+            """
+
+
 @mcp.tool
 async def start_and_select_universities(
     background: str,
@@ -374,23 +920,26 @@ async def start_and_select_universities(
     if not country or not isinstance(country, str):
         raise ValueError("country is required and must be a string")
 
-    if strategy not in ["conservative", "aggressive"]:
+    if strategy not in STRATEGY_RATIOS:
         raise ValueError("strategy must be 'conservative' or 'aggressive'")
 
+    # Bound payload size before parsing or walking it
+    _assert_payload_limits("selected_universities", selected_universities)
+    _assert_payload_limits("optional_web_searches", optional_web_searches)
+
     # ═══════════════════════════════════════════════════════════════
     # TYPE COERCION: Handle MCP serialization issues
     # ═══════════════════════════════════════════════════════════════
     # MCP may serialize None/empty list as strings, fix it here
-    import json
-
     if isinstance(selected_universities, str):
         if selected_universities == "" or selected_universities.lower() == "null":
             selected_universities = None
         else:
             try:
                 selected_universities = json.loads(selected_universities)
-            except json.JSONDecodeError:
+            except (json.JSONDecodeError, RecursionError):
                 raise ValueError(f"Invalid selected_universities format: {selected_universities}")
+            _assert_payload_limits("selected_universities", selected_universities)
 
     if isinstance(optional_web_searches, str):
         if optional_web_searches == "" or optional_web_searches.lower() == "null":
@@ -398,59 +947,25 @@ async def start_and_select_universities(
         else:
             try:
                 optional_web_searches = json.loads(optional_web_searches)
-            except json.JSONDecodeError:
+            except (json.JSONDecodeError, RecursionError):
                 raise ValueError(f"Invalid optional_web_searches format: {optional_web_searches}")
+            _assert_payload_limits("optional_web_searches", optional_web_searches)
     # ═══════════════════════════════════════════════════════════════
 
     # Get all universities in country
     all_universities = _list_universities(country)
 
     if not all_universities:
-        available = _get_available_countries()
-        countries_str = ", ".join([f"{c['country']} ({c['count']})" for c in available[:10]])
-        raise ValueError(f"Country '{country}' not found. Available: {countries_str}")
-
-    # Strategy ratios
-    strategy_ratios = {
-        "conservative": {"lottery": "10%", "reach": "30%", "target": "40%", "safety": "20%"},
-        "aggressive": {"lottery": "20%", "reach": "50%", "target": "20%", "safety": "10%"}
-    }
-    ratios = strategy_ratios[strategy]
+        raise ValueError(f"Country '{country}' not found. Available: {_get_top_countries_suggestion()}")
 
     # CALL 1: Return all universities (exploration phase)
     if not selected_universities:
         return {
-            "all_universities": all_universities,
+            "all_universities": list(all_universities),
             "total_universities": len(all_universities),
             "country": country,
             "strategy": strategy,
-            "instructions": f"""
-COUNTRY: {country}
-TOTAL UNIVERSITIES: {len(all_universities)}
-STRATEGY: {strategy.upper()}
-
-All universities in {country}:
-{chr(10).join([f"  • {uni}" for uni in all_universities])}
-
-YOUR TASK: Select universities matching student's profile (max 14)
-
-SELECTION STRATEGY ({strategy.capitalize()}):
-1. Analyze student profile (GPA, background, goals)
-
-2. Build portfolio across difficulty levels:
-   - Lottery: {ratios['lottery']} (Dream schools, extremely competitive)
-   - Reach: {ratios['reach']} (Highly competitive, student slightly below average)
-   - Target: {ratios['target']} (Competitive match, student fits typical profile)
-   - Safety: {ratios['safety']} (Strong admission likelihood, student above average)
-
-3. Optional: 0-3 web searches if uncertain about specific universities
-
-NEXT STEP:
-Call start_and_select_universities() AGAIN with:
-- Same background, country, strategy
-- selected_universities: [chosen university names]
-- optional_web_searches: [...] (if needed)
-            """,
+            "instructions": _university_selection_instructions(country, strategy),
             "next_step": "Call start_and_select_universities() again with selected_universities"
         }
 
@@ -467,13 +982,13 @@ Call start_and_select_universities() AGAIN with:
         if len(optional_web_searches) > 3:
             raise ValueError(f"Maximum 3 web searches allowed. You provided {len(optional_web_searches)}.")
 
-        for i, search in enumerate(optional_web_searches):
-            if not isinstance(search, dict) or "query" not in search or "num_results" not in search:
-                raise ValueError(f"Search #{i+1} must be a dict with 'query' and 'num_results' fields")
+        for i, search in enumerate(optional_web_searches, 1):
+            num_results = search.get("num_results") if isinstance(search, dict) else None
+            if num_results is None or "query" not in search:
+                raise ValueError(f"Search #{i} must be a dict with 'query' and 'num_results' fields")
 
-            num_results = search["num_results"]
-            if not isinstance(num_results, int) or num_results < 1 or num_results > 25:
-                raise ValueError(f"Search #{i+1}: num_results must be 1-25. You provided {num_results}")
+            if not isinstance(num_results, int) or not 1 <= num_results <= 25:
+                raise ValueError(f"Search #{i}: num_results must be 1-25. You provided {num_results}")
 
         search_count = len(optional_web_searches)
 
@@ -485,19 +1000,23 @@ Call start_and_select_universities() AGAIN with:
             f"Maximum 14 universities allowed to avoid context overflow. Please reduce your selection."
         )
 
-    # Validate selected universities
-    invalid_universities = [uni for uni in selected_universities if uni not in all_universities]
-    if invalid_universities:
+    # Validate selected universities (set membership, O(1) per name); the offending
+    # list is only built when the check fails
+    known_universities = _known_universities(country)
+    if (not all(isinstance(uni, str) for uni in selected_universities)
+            or not known_universities.issuperset(selected_universities)):
+        invalid_universities = [
+            uni for uni in selected_universities
+            if not isinstance(uni, str) or uni not in known_universities
+        ]
         raise ValueError(f"Invalid universities: {invalid_universities[:5]}... Please select from the provided list.")
 
-    token = generate_token("selection", {
+    token = await generate_token("selection", {
         "background": background,
         "country": country,
         "strategy": strategy,
-        "all_universities": all_universities,
         "selected_universities": selected_universities,
-        "web_searches_completed": search_count,
-        "web_searches_data": optional_web_searches or []
+        "web_searches_completed": search_count
     })
 
     return {
@@ -549,66 +1068,35 @@ async def select_classifications(
     # API key validation
     tier, allowed_tools = validate_api_key_and_tool("select_classifications")
 
+    # Bound payload size before parsing or walking it
+    _assert_payload_limits("selected_classifications", selected_classifications)
+
     # ═══════════════════════════════════════════════════════════════
     # TYPE COERCION: Handle MCP serialization issues
     # ═══════════════════════════════════════════════════════════════
-    import json
     if isinstance(selected_classifications, str):
         if selected_classifications == "" or selected_classifications.lower() == "null":
             selected_classifications = None
         else:
             try:
                 selected_classifications = json.loads(selected_classifications)
-            except json.JSONDecodeError:
+            except (json.JSONDecodeError, RecursionError):
                 raise ValueError(f"Invalid selected_classifications format: {selected_classifications}")
+            _assert_payload_limits("selected_classifications", selected_classifications)
     # ═══════════════════════════════════════════════════════════════
 
     # Validate token
-    selection_data = validate_token(selection_token, "selection")
+    selection_data = await validate_token(selection_token, "selection")
     background = selection_data.get("background", "")
     strategy = selection_data.get("strategy", "conservative")
     selected_universities = selection_data.get("selected_universities", [])
 
     # CALL 1: Return all classifications
     if not selected_classifications:
-        classification_list = [
-            {"id": 1, "name": "Health Sciences & Medicine", "description": "Healthcare, nursing, public health, biomedical sciences"},
-            {"id": 2, "name": "Business & Management", "description": "Business administration, management, entrepreneurship, marketing"},
-            {"id": 3, "name": "Engineering", "description": "All engineering disciplines (mechanical, civil, electrical, etc.)"},
-            {"id": 4, "name": "Social Sciences", "description": "Psychology, sociology, anthropology, political science, international relations"},
-            {"id": 5, "name": "Education", "description": "Teaching, educational leadership, curriculum development"},
-            {"id": 6, "name": "Humanities & Languages", "description": "Literature, linguistics, history, philosophy, languages"},
-            {"id": 7, "name": "Arts Media & Design", "description": "Visual arts, performing arts, media, design, communication"},
-            {"id": 8, "name": "Computing & Data Science", "description": "Computer science, software engineering, data science, AI/ML"},
-            {"id": 9, "name": "Physical & Mathematical Sciences", "description": "Mathematics, statistics, physics, chemistry, astronomy"},
-            {"id": 10, "name": "Law & Public Policy", "description": "Law, legal studies, public administration, policy analysis"},
-            {"id": 11, "name": "Life Sciences", "description": "Biology, biotechnology, genetics, neuroscience, biochemistry"},
-            {"id": 12, "name": "Finance & Economics", "description": "Finance, economics, accounting, financial engineering"},
-            {"id": 13, "name": "Architecture & Planning", "description": "Architecture, urban planning, landscape architecture"},
-            {"id": 14, "name": "Environment & Sustainability", "description": "Environmental science, sustainability, conservation, climate"},
-            {"id": 15, "name": "Interdisciplinary Studies", "description": "Cross-disciplinary programs, liberal studies, general research"}
-        ]
-
         return {
-            "all_classifications": classification_list,
+            "all_classifications": list(CLASSIFICATION_LIST),
             "total_classifications": 15,
-            "instructions": f"""
-ALL 15 CLASSIFICATION CATEGORIES
-
-{chr(10).join([f"  {c['id']:2d}. {c['name']:40s} - {c['description']}" for c in classification_list])}
-
-YOUR TASK: Select relevant classifications based on student background
-
-SELECTION STRATEGY:
-1. PRIMARY: Direct match with student's major/field/career goals
-2. SECONDARY: Related/complementary fields student might consider
-3. Be inclusive but sensible - avoid obviously irrelevant fields
-
-NEXT STEP:
-Call select_classifications() AGAIN with:
-- Same selection_token
-- selected_classifications: [list of chosen classification names]
-            """,
+            "instructions": _CLASSIFICATION_SELECTION_INSTRUCTIONS,
             "next_step": "Call select_classifications() again with selected_classifications"
         }
 
@@ -617,12 +1105,11 @@ Call select_classifications() AGAIN with:
         raise ValueError("selected_classifications must be a non-empty list for Call 2")
 
     # Validate classification names
-    valid_names = list(CLASSIFICATIONS.values())
-    invalid_classifications = [c for c in selected_classifications if c not in valid_names]
+    invalid_classifications = [c for c in selected_classifications if c not in VALID_CLASSIFICATION_NAMES]
     if invalid_classifications:
         raise ValueError(f"Invalid classifications: {invalid_classifications}. Must match exact names from the list.")
 
-    token = generate_token("classifications", {
+    token = await generate_token("classifications", {
         "background": background,
         "strategy": strategy,
         "selected_universities": selected_universities,
@@ -669,22 +1156,31 @@ async def process_university_programs(
     # API key validation
     tier, allowed_tools = validate_api_key_and_tool("process_university_programs")
 
+    # Bound payload size before parsing or walking it
+    _assert_payload_limits("university_programs", university_programs)
+
     # ═══════════════════════════════════════════════════════════════
     # TYPE COERCION: Handle MCP serialization issues
     # ═══════════════════════════════════════════════════════════════
-    import json
     if isinstance(university_programs, str):
         if university_programs == "" or university_programs.lower() == "null":
             university_programs = None
         else:
             try:
                 university_programs = json.loads(university_programs)
-            except json.JSONDecodeError:
+            except (json.JSONDecodeError, RecursionError):
                 raise ValueError(f"Invalid university_programs format: {university_programs}")
+            _assert_payload_limits("university_programs", university_programs)
     # ═══════════════════════════════════════════════════════════════
 
+    # Retried calls with identical arguments get the original response (and token) back
+    request_key = _request_key("process_university_programs", classifications_token, university_programs)
+    cached = _tool_responses.get(request_key)
+    if cached is not None:
+        return cached
+
     # Validate token
-    classifications_data = validate_token(classifications_token, "classifications")
+    classifications_data = await validate_token(classifications_token, "classifications")
     background = classifications_data.get("background", "")
     strategy = classifications_data.get("strategy", "conservative")
     selected_universities = classifications_data.get("selected_universities", [])
@@ -700,24 +1196,28 @@ async def process_university_programs(
     if university_programs is None:
         university_programs = {}
 
-    processed_universities = list(university_programs.keys())
-    remaining_universities = [uni for uni in selected_universities if uni not in processed_universities]
+    # Dict membership keeps this O(1) per university while preserving selection order
+    remaining_universities = [uni for uni in selected_universities if uni not in university_programs]
 
     # If all universities processed, generate final token
     if not remaining_universities:
         # Calculate total programs
         total_programs = sum(len(programs) for programs in university_programs.values())
 
-        token = generate_token("programs", {
+        # Prefetch details for every selected program in one query; analyze_and_shortlist reuses them.
+        # Keyed by str(program_id) so the index survives a JSON round trip through the token database.
+        program_ids = [pid for programs in university_programs.values() for pid in programs]
+        program_details = await asyncio.to_thread(_get_program_details_batch, program_ids)
+
+        token = await generate_token("programs", {
             "background": background,
             "strategy": strategy,
             "universities": selected_universities,
             "university_programs": university_programs,
-            "total_programs": total_programs,
-            "selected_classifications": selected_classifications
+            "program_details": {str(p["program_id"]): p for p in program_details}
         })
 
-        return {
+        return _remember_response(request_key, {
             "programs_token": token,
             "total_programs": total_programs,
             "universities_processed": len(university_programs),
@@ -733,17 +1233,17 @@ NEXT STEP: Analyze and shortlist programs
 Call analyze_and_shortlist(programs_token, university_analyses) to begin university-by-university analysis and shortlisting.
             """,
             "next_step": "Call analyze_and_shortlist(programs_token, university_analyses)"
-        }
+        })
 
     # Process next university
     current_university = remaining_universities[0]
 
-    # Get filtered programs for current university
-    programs = _search_programs(current_university, classification_filters=selected_classifications)
+    # Get filtered programs for current university (SQLite read runs in a worker thread)
+    programs = await asyncio.to_thread(_search_programs, current_university, selected_classifications)
 
     if not programs:
         # Skip universities with no matching programs
-        return {
+        return _remember_response(request_key, {
             "current_university": current_university,
             "programs": [],
             "program_count": 0,
@@ -761,12 +1261,12 @@ Call process_university_programs(classifications_token, university_programs) aga
 
 WARNING: DO NOT SKIP AHEAD. Process remaining {len(remaining_universities) - 1} universities before proceeding.
             """
-        }
+        })
 
     # Format programs for display
     programs_display = "\n".join([f"  • [{p['id']}] {p['name']} ({p['degree']})" for p in programs])
 
-    return {
+    return _remember_response(request_key, {
         "current_university": current_university,
         "programs": programs,
         "program_count": len(programs),
@@ -789,7 +1289,7 @@ Call process_university_programs(classifications_token, university_programs) aga
 
 WARNING: DO NOT SKIP AHEAD. Process remaining {len(remaining_universities) - 1} universities before proceeding.
         """
-    }
+    })
 
 
 @mcp.tool
@@ -821,34 +1321,45 @@ async def analyze_and_shortlist(
     # API key validation
     tier, allowed_tools = validate_api_key_and_tool("analyze_and_shortlist")
 
+    # Bound payload size before parsing or walking it
+    _assert_payload_limits("university_analyses", university_analyses)
+
     # ═══════════════════════════════════════════════════════════════
     # TYPE COERCION: Handle MCP serialization issues
     # ═══════════════════════════════════════════════════════════════
-    import json
     if isinstance(university_analyses, str):
         if university_analyses == "" or university_analyses.lower() == "null":
             university_analyses = None
         else:
             try:
                 university_analyses = json.loads(university_analyses)
-            except json.JSONDecodeError:
+            except (json.JSONDecodeError, RecursionError):
                 raise ValueError(f"Invalid university_analyses format: {university_analyses}")
+            _assert_payload_limits("university_analyses", university_analyses)
     # ═══════════════════════════════════════════════════════════════
 
+    # Retried calls with identical arguments get the original response (and token) back
+    request_key = _request_key("analyze_and_shortlist", programs_token, university_analyses)
+    cached = _tool_responses.get(request_key)
+    if cached is not None:
+        return cached
+
     # Validate token (accepts both "programs" and "accumulation" types)
-    token_data = _active_tokens.get(programs_token)
+    token_data = await lookup_token(programs_token)
     if not token_data:
         raise ValueError("Invalid or expired token")
 
-    token_type = token_data.get("type")
+    token_type = token_data.type
     if token_type == "programs":
         # First call: extract from programs token
-        programs_data = validate_token(programs_token, "programs")
+        programs_data = await validate_token(programs_token, "programs")
         accumulated_analyses = {}  # No history yet
+        details_token = programs_token
     elif token_type == "accumulation":
         # Subsequent calls: extract from accumulation token
-        programs_data = validate_token(programs_token, "accumulation")
+        programs_data = await validate_token(programs_token, "accumulation")
         accumulated_analyses = programs_data.get("accumulated_analyses", {})
+        details_token = programs_data.get("programs_token")
     else:
         raise ValueError(f"Invalid token type: {token_type}. Expected 'programs' or 'accumulation'")
 
@@ -868,17 +1379,17 @@ async def analyze_and_shortlist(
                 f"Submit only ONE university per call. You submitted {len(university_analyses)} universities: {list(university_analyses.keys())}\n"
                 f"The server will merge analyses automatically."
             )
-        accumulated_analyses.update(university_analyses)
+        # New dict: the incoming token's analyses stay as issued (matching its persisted snapshot)
+        accumulated_analyses = {**accumulated_analyses, **university_analyses}
 
-    processed_universities = list(accumulated_analyses.keys())
-    remaining_universities = [uni for uni in universities if uni not in processed_universities]
+    remaining_universities = [uni for uni in universities if uni not in accumulated_analyses]
 
     # If all universities processed, generate final token
     if not remaining_universities:
         # Calculate total programs
         total_programs = sum(len(analysis.get("shortlisted_programs", [])) for analysis in accumulated_analyses.values())
 
-        token = generate_token("analysis", {
+        token = await generate_token("analysis", {
             "background": background,
             "strategy": strategy,
             "universities": universities,
@@ -886,7 +1397,7 @@ async def analyze_and_shortlist(
             "total_programs": total_programs
         })
 
-        return {
+        return _remember_response(request_key, {
             "analysis_token": token,
             "total_programs_shortlisted": total_programs,
             "universities_analyzed": len(accumulated_analyses),
@@ -902,14 +1413,15 @@ NEXT STEP: Select final programs
 Call select_final_programs(analysis_token, final_programs) to choose final programs based on {strategy} strategy.
             """,
             "next_step": "Call select_final_programs(analysis_token, final_programs)"
-        }
+        })
 
     # Generate accumulation token for next call
-    accumulation_token = generate_token("accumulation", {
+    accumulation_token = await generate_token("accumulation", {
         "background": background,
         "strategy": strategy,
         "universities": universities,
         "university_programs": university_programs,
+        "programs_token": details_token,  # Holds the prefetched program details (not copied per call)
         "accumulated_analyses": accumulated_analyses
     })
 
@@ -919,7 +1431,7 @@ Call select_final_programs(analysis_token, final_programs) to choose final progr
 
     if not current_programs:
         # Skip universities with no programs
-        return {
+        return _remember_response(request_key, {
             "accumulation_token": accumulation_token,
             "current_university": current_university,
             "program_count": 0,
@@ -939,16 +1451,23 @@ Call analyze_and_shortlist(accumulation_token, university_analyses) again with:
 
 WARNING: DO NOT SKIP AHEAD. Process remaining {len(remaining_universities) - 1} universities before proceeding.
             """
-        }
+        })
 
-    # Get program details
-    program_details = _get_program_details_batch(current_programs)
+    # Get program details from the programs token's prefetched index; fall back to SQLite
+    # (in a worker thread) for IDs it does not hold or once that token has expired
+    details_entry = await lookup_token(details_token)
+    program_details_by_id = details_entry.data.get("program_details", {}) if details_entry else {}
+    unique_programs = list(dict.fromkeys(map(str, current_programs)))
+    if all(pid in program_details_by_id for pid in unique_programs):
+        program_details = [program_details_by_id[pid] for pid in unique_programs]
+    else:
+        program_details = await asyncio.to_thread(_get_program_details_batch, current_programs)
     programs_display = "\n".join([
         f"  • [{p['program_id']}] {p['program_name']} ({p['degree_type']})"
         for p in program_details
     ])
 
-    return {
+    return _remember_response(request_key, {
         "accumulation_token": accumulation_token,
         "current_university": current_university,
         "programs": program_details,
@@ -987,7 +1506,7 @@ IMPORTANT: Only send data for {current_university}, not previous universities.
 
 Progress: {len(accumulated_analyses)} done, {len(remaining_universities)} remaining
         """
-    }
+    })
 
 
 @mcp.tool
@@ -1012,91 +1531,73 @@ async def upgrade_to_advanced(
     tier_from_key, allowed_tools = validate_api_key_and_tool("upgrade_to_advanced")
     # ═══════════════════════════════════════════════════════════════
 
-    import psycopg2
-    import json
-    from datetime import datetime
-
     # Load consultation state from PostgreSQL
     try:
-        conn = psycopg2.connect(
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432"),
-            dbname=os.getenv("POSTGRES_DB", "offeri"),
-            user=os.getenv("POSTGRES_USER", "offeri_user"),
-            password=os.getenv("POSTGRES_PASSWORD", "")
-        )
-        cursor = conn.cursor()
-
-        # Fetch consultation state
-        cursor.execute("""
-            SELECT user_id, tier, workflow_step, workflow_data, created_at, expires_at
-            FROM consultation_states
-            WHERE id = %s
-        """, (consultation_state_id,))
+        with _pg_connection() as conn, conn.cursor() as cursor:
+            # Fetch consultation state
+            cursor.execute("""
+                SELECT user_id, tier, workflow_step, workflow_data, created_at, expires_at
+                FROM consultation_states
+                WHERE id = %s
+            """, (consultation_state_id,))
 
-        result = cursor.fetchone()
-        if not result:
-            conn.close()
-            raise ValueError(
-                f"Consultation state not found: {consultation_state_id}\n\n"
-                f"This state ID may be invalid, expired, or already used.\n"
-                f"Please start a new basic consultation."
-            )
+            result = cursor.fetchone()
+            if not result:
+                raise ValueError(
+                    f"Consultation state not found: {consultation_state_id}\n\n"
+                    f"This state ID may be invalid, expired, or already used.\n"
+                    f"Please start a new basic consultation."
+                )
 
-        user_id, tier, workflow_step, workflow_data_json, created_at, expires_at = result
+            user_id, tier, workflow_step, workflow_data_json, created_at, expires_at = result
 
-        # Check if expired
-        if expires_at < datetime.utcnow():
-            conn.close()
-            raise ValueError(
-                f"Consultation state expired: {consultation_state_id}\n\n"
-                f"Created: {created_at}\n"
-                f"Expired: {expires_at}\n\n"
-                f"Consultation states are valid for 7 days. Please start a new basic consultation."
-            )
+            # Check if expired
+            if expires_at < datetime.utcnow():
+                raise ValueError(
+                    f"Consultation state expired: {consultation_state_id}\n\n"
+                    f"Created: {created_at}\n"
+                    f"Expired: {expires_at}\n\n"
+                    f"Consultation states are valid for 7 days. Please start a new basic consultation."
+                )
 
-        # Verify tier is basic
-        if tier != 'basic':
-            conn.close()
-            raise ValueError(
-                f"Invalid upgrade request: {consultation_state_id}\n\n"
-                f"This consultation state is for tier '{tier}', not 'basic'.\n"
-                f"Only basic tier consultations can be upgraded to advanced."
-            )
+            # Verify tier is basic
+            if tier != 'basic':
+                raise ValueError(
+                    f"Invalid upgrade request: {consultation_state_id}\n\n"
+                    f"This consultation state is for tier '{tier}', not 'basic'.\n"
+                    f"Only basic tier consultations can be upgraded to advanced."
+                )
 
-        # Verify workflow step
-        if workflow_step != 'validation_complete':
-            conn.close()
-            raise ValueError(
-                f"Invalid workflow state: {consultation_state_id}\n\n"
-                f"Current workflow step: {workflow_step}\n"
-                f"Expected: validation_complete\n\n"
-                f"This consultation is not ready for upgrade."
-            )
+            # Verify workflow step
+            if workflow_step != 'validation_complete':
+                raise ValueError(
+                    f"Invalid workflow state: {consultation_state_id}\n\n"
+                    f"Current workflow step: {workflow_step}\n"
+                    f"Expected: validation_complete\n\n"
+                    f"This consultation is not ready for upgrade."
+                )
 
-        # Parse workflow data
-        workflow_data = json.loads(workflow_data_json)
-        validation_token = workflow_data.get("validation_token")
-        total_programs = workflow_data.get("total_programs")
-        universities = workflow_data.get("universities", [])
+            # Parse workflow data
+            workflow_data = json.loads(workflow_data_json)
+            validation_token = workflow_data.get("validation_token")
+            total_programs = workflow_data.get("total_programs")
+            universities = workflow_data.get("universities", [])
 
-        if not validation_token:
-            conn.close()
-            raise ValueError(
-                f"Invalid consultation state: {consultation_state_id}\n\n"
-                f"Missing validation_token in workflow_data.\n"
-                f"This state may be corrupted. Please start a new basic consultation."
-            )
+            if not validation_token:
+                raise ValueError(
+                    f"Invalid consultation state: {consultation_state_id}\n\n"
+                    f"Missing validation_token in workflow_data.\n"
+                    f"This state may be corrupted. Please start a new basic consultation."
+                )
 
-        # Update consultation state to 'advanced' tier
-        cursor.execute("""
-            UPDATE consultation_states
-            SET tier = 'advanced', workflow_step = 'upgrade_initiated'
-            WHERE id = %s
-        """, (consultation_state_id,))
+            # Update consultation state to 'advanced' tier
+            cursor.execute("""
+                UPDATE consultation_states
+                SET tier = 'advanced', workflow_step = 'upgrade_initiated'
+                WHERE id = %s
+            """, (consultation_state_id,))
 
-        conn.commit()
-        conn.close()
+            conn.commit()
 
         logger.info(f"UPGRADE: {consultation_state_id} upgraded from basic to advanced for user {user_id}")
 
@@ -1146,6 +1647,35 @@ Next Step:
         )
 
 
+# Select-final-programs response template (only the counts, range and strategy vary per call)
+_FINAL_SELECTION_INSTRUCTIONS = """
+FINAL PROGRAMS SELECTED
+
+RESULTS:
+- Universities: {university_count}
+- Programs selected: {program_count}
+- Recommended range: {range_guidance}
+- Strategy: {strategy}
+- Recommended distribution:
+  - Lottery: {lottery}
+  - Reach: {reach}
+  - Target: {target}
+  - Safety: {safety}
+
+NEXT STEP: Generate final report
+
+ALL TIERS: First call generate_final_report(selection_token, program_analyses)
+
+The function will return:
+- Basic tier: Report markdown (consultation complete)
+- Advanced tier: Report markdown + can_generate_advanced=true
+  → Then call generate_final_report_advanced(selection_token, program_research)
+- Upgrade tier: Report markdown + consultation_state_id
+  → Then call upgrade_to_advanced(consultation_state_id) first
+  → Then call generate_final_report_advanced(selection_token, program_research)
+        """
+
+
 @mcp.tool
 async def select_final_programs(
     analysis_token: str,
@@ -1164,19 +1694,22 @@ async def select_final_programs(
     # API key validation
     tier, allowed_tools = validate_api_key_and_tool("select_final_programs")
 
+    # Bound payload size before parsing or walking it
+    _assert_payload_limits("final_programs", final_programs)
+
     # ═══════════════════════════════════════════════════════════════
     # TYPE COERCION: Handle MCP serialization issues
     # ═══════════════════════════════════════════════════════════════
-    import json
     if isinstance(final_programs, str):
         try:
             final_programs = json.loads(final_programs)
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, RecursionError):
             raise ValueError(f"Invalid final_programs format: {final_programs}")
+        _assert_payload_limits("final_programs", final_programs)
     # ═══════════════════════════════════════════════════════════════
 
     # Validate token
-    analysis_data = validate_token(analysis_token, "analysis")
+    analysis_data = await validate_token(analysis_token, "analysis")
     background = analysis_data.get("background", "")
     strategy = analysis_data.get("strategy", "conservative")
     university_analyses = analysis_data.get("university_analyses", {})
@@ -1192,12 +1725,7 @@ async def select_final_programs(
         min_programs = 20
         range_guidance = "at least 20 programs (more universities, broader coverage)"
 
-    # Strategy ratios for guidance
-    strategy_ratios = {
-        "conservative": {"lottery": "10%", "reach": "30%", "target": "40%", "safety": "20%"},
-        "aggressive": {"lottery": "20%", "reach": "50%", "target": "20%", "safety": "10%"}
-    }
-    ratios = strategy_ratios[strategy]
+    ratios = STRATEGY_RATIOS[strategy]
 
     # Validate final_programs
     if not final_programs or not isinstance(final_programs, list):
@@ -1214,7 +1742,7 @@ async def select_final_programs(
         )
 
     # Generate selection token
-    token = generate_token("selection", {
+    token = await generate_token("selection", {
         "background": background,
         "strategy": strategy,
         "final_programs": final_programs,
@@ -1228,34 +1756,70 @@ async def select_final_programs(
         "strategy": strategy,
         "university_count": university_count,
         "program_range": range_guidance,
-        "instructions": f"""
-FINAL PROGRAMS SELECTED
+        "instructions": _FINAL_SELECTION_INSTRUCTIONS.format(
+            university_count=university_count,
+            program_count=program_count,
+            range_guidance=range_guidance,
+            strategy=strategy.capitalize(),
+            **ratios
+        ),
+        "next_step": "Call generate_final_report(selection_token, program_analyses) [ALL TIERS]"
+    }
 
-RESULTS:
-- Universities: {university_count}
-- Programs selected: {program_count}
-- Recommended range: {range_guidance}
-- Strategy: {strategy.capitalize()}
-- Recommended distribution:
-  - Lottery: {ratios['lottery']}
-  - Reach: {ratios['reach']}
-  - Target: {ratios['target']}
-  - Safety: {ratios['safety']}
 
-NEXT STEP: Generate final report
+# generate_final_report validation messages, keyed by problem code
+_ANALYSIS_ERROR_TEMPLATES = {
+    "missing_entry_field": "program_analyses[{i}] missing 'program_id' or 'analysis' field",
+    "analysis_not_object": "program_analyses[{i}].analysis must be an object",
+    "missing_analysis_field": "program_analyses[{i}].analysis missing '{field}' field",
+    "analysis_field_too_short": (
+        "program_analyses[{i}].analysis.{field} must be ≥100 characters. "
+        "Current: {length} characters"
+    ),
+}
 
-ALL TIERS: First call generate_final_report(selection_token, program_analyses)
+# Report response templates (only the counts, tier and state id vary per call)
+_BASIC_REPORT_MARKDOWN = """# Study Abroad Consultation Report
 
-The function will return:
-- Basic tier: Report markdown (consultation complete)
-- Advanced tier: Report markdown + can_generate_advanced=true
-  → Then call generate_final_report_advanced(selection_token, program_research)
-- Upgrade tier: Report markdown + consultation_state_id
-  → Then call upgrade_to_advanced(consultation_state_id) first
-  → Then call generate_final_report_advanced(selection_token, program_research)
-        """,
-        "next_step": "Call generate_final_report(selection_token, program_analyses) [ALL TIERS]"
-    }
+## Basic Tier Report
+
+Total Programs: {program_count}
+
+(Report content will be generated by LLM based on program_analyses)
+"""
+
+_BASIC_REPORT_INSTRUCTIONS = """
+BASIC REPORT GENERATED
+
+KEY INFO:
+- Tier: {tier}
+- Programs: {program_count}
+- Can generate advanced: {can_generate_advanced}
+"""
+
+_UPGRADE_TIER_INSTRUCTIONS = """
+UPGRADE TIER:
+- Consultation state saved: {consultation_state_id}
+- To generate advanced report:
+  1. Call upgrade_to_advanced(consultation_state_id="{consultation_state_id}")
+  2. Then call generate_final_report_advanced(selection_token, program_research)
+"""
+
+_ADVANCED_TIER_INSTRUCTIONS = """
+ADVANCED TIER:
+- You can now directly call generate_final_report_advanced(selection_token, program_research)
+- Use 2 Exa searches per program (curriculum + career outcomes)
+"""
+
+_ADVANCED_REPORT_MESSAGE = """Report ready for generation.
+
+INSTRUCTIONS:
+- Programs to analyze: {program_count} programs
+- Each program: 200-400 words with Exa research findings
+- Output in user's language
+- DO NOT include tuition/timeline/costs
+- Focus on program characteristics and student fit
+        """
 
 
 @mcp.tool
@@ -1282,19 +1846,22 @@ async def generate_final_report(
     # API key validation
     tier, allowed_tools = validate_api_key_and_tool("generate_final_report")
 
+    # Bound payload size before parsing or walking it
+    _assert_payload_limits("program_analyses", program_analyses)
+
     # ═══════════════════════════════════════════════════════════════
     # TYPE COERCION: Handle MCP serialization issues
     # ═══════════════════════════════════════════════════════════════
-    import json
     if isinstance(program_analyses, str):
         try:
             program_analyses = json.loads(program_analyses)
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, RecursionError):
             raise ValueError(f"Invalid program_analyses format: {program_analyses}")
+        _assert_payload_limits("program_analyses", program_analyses)
     # ═══════════════════════════════════════════════════════════════
 
     # Extract data from selection token
-    selection_data = validate_token(selection_token, "selection")
+    selection_data = await validate_token(selection_token, "selection")
     background = selection_data.get("background", "")
     strategy = selection_data.get("strategy", "conservative")
     final_programs = selection_data.get("final_programs", [])
@@ -1305,64 +1872,65 @@ async def generate_final_report(
     if not program_analyses or not isinstance(program_analyses, list):
         raise ValueError("program_analyses must be a non-empty list")
 
-    # Validate each analysis has required fields
+    # Validate each analysis has required fields (single pass, report every problem at once).
+    # Problems are collected as (code, index, field, length) and only formatted if we raise.
+    errors = []
     for i, analysis in enumerate(program_analyses):
-        if "program_id" not in analysis or "analysis" not in analysis:
-            raise ValueError(f"program_analyses[{i}] missing 'program_id' or 'analysis' field")
+        if not isinstance(analysis, dict) or "program_id" not in analysis or "analysis" not in analysis:
+            errors.append(("missing_entry_field", i, None, None))
+            continue
 
         analysis_content = analysis["analysis"]
-        required_fields = ["program_features", "student_experience", "suitability_analysis"]
-        for field in required_fields:
-            if field not in analysis_content:
-                raise ValueError(f"program_analyses[{i}].analysis missing '{field}' field")
-            if len(analysis_content[field]) < 100:
-                raise ValueError(
-                    f"program_analyses[{i}].analysis.{field} must be ≥100 characters. "
-                    f"Current: {len(analysis_content[field])} characters"
-                )
+        if not isinstance(analysis_content, dict):
+            errors.append(("analysis_not_object", i, None, None))
+            continue
+
+        missing_fields = REQUIRED_ANALYSIS_FIELD_SET - analysis_content.keys()
+        for field in REQUIRED_ANALYSIS_FIELDS:
+            if field in missing_fields:
+                errors.append(("missing_analysis_field", i, field, None))
+                continue
+            length = len(analysis_content[field])
+            if length < 100:
+                errors.append(("analysis_field_too_short", i, field, length))
+
+    if errors:
+        raise ValueError(
+            f"Found {len(errors)} problem(s) in program_analyses:\n" + "\n".join(
+                _ANALYSIS_ERROR_TEMPLATES[code].format(i=i, field=field, length=length)
+                for code, i, field, length in errors
+            )
+        )
 
     # Generate basic report markdown (placeholder for now - LLM will generate)
-    report_markdown = f"""# Study Abroad Consultation Report
-
-## Basic Tier Report
-
-Total Programs: {len(program_analyses)}
-
-(Report content will be generated by LLM based on program_analyses)
-"""
+    report_markdown = _BASIC_REPORT_MARKDOWN.format(program_count=len(program_analyses))
 
     # Determine tier-specific behavior
-    can_generate_advanced = tier in ["advanced", "upgrade"]
+    can_generate_advanced = tier in ("advanced", "upgrade")
     consultation_state_id = None
 
     # For "upgrade" tier, save consultation state to PostgreSQL
     if tier == "upgrade":
-        import uuid
-        import psycopg2
-
         consultation_state_id = f"cs_{uuid.uuid4().hex[:12]}"
 
         try:
-            conn = get_pg_connection()
-            cursor = conn.cursor()
-
-            # Save consultation state
-            cursor.execute("""
-                INSERT INTO consultation_states
-                (consultation_state_id, user_id, background, strategy, universities, final_programs, university_analyses, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
-            """, (
-                consultation_state_id,
-                _current_user_id,
-                background,
-                strategy,
-                json.dumps(list(university_analyses.keys())),
-                json.dumps(final_programs),
-                json.dumps(university_analyses)
-            ))
-
-            conn.commit()
-            conn.close()
+            with _pg_connection() as conn, conn.cursor() as cursor:
+                # Save consultation state
+                cursor.execute("""
+                    INSERT INTO consultation_states
+                    (consultation_state_id, user_id, background, strategy, universities, final_programs, university_analyses, created_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+                """, (
+                    consultation_state_id,
+                    _current_user_id,
+                    background,
+                    strategy,
+                    json.dumps(list(university_analyses.keys())),
+                    json.dumps(final_programs),
+                    json.dumps(university_analyses)
+                ))
+
+                conn.commit()
 
             logger.info(f"CONSULTATION STATE SAVED: {consultation_state_id} for user {_current_user_id}")
 
@@ -1377,32 +1945,19 @@ Total Programs: {len(program_analyses)}
         "programs_analyzed": len(program_analyses),
         "key_type": tier,
         "can_generate_advanced": can_generate_advanced,
-        "instructions": f"""
-BASIC REPORT GENERATED
-
-KEY INFO:
-- Tier: {tier}
-- Programs: {len(program_analyses)}
-- Can generate advanced: {can_generate_advanced}
-"""
+        "instructions": _BASIC_REPORT_INSTRUCTIONS.format(
+            tier=tier,
+            program_count=len(program_analyses),
+            can_generate_advanced=can_generate_advanced
+        )
     }
 
     # Add consultation_state_id for upgrade tier
     if tier == "upgrade":
         result["consultation_state_id"] = consultation_state_id
-        result["instructions"] += f"""
-UPGRADE TIER:
-- Consultation state saved: {consultation_state_id}
-- To generate advanced report:
-  1. Call upgrade_to_advanced(consultation_state_id="{consultation_state_id}")
-  2. Then call generate_final_report_advanced(selection_token, program_research)
-"""
+        result["instructions"] += _UPGRADE_TIER_INSTRUCTIONS.format(consultation_state_id=consultation_state_id)
     elif tier == "advanced":
-        result["instructions"] += """
-ADVANCED TIER:
-- You can now directly call generate_final_report_advanced(selection_token, program_research)
-- Use 2 Exa searches per program (curriculum + career outcomes)
-"""
+        result["instructions"] += _ADVANCED_TIER_INSTRUCTIONS
 
     return result
 
@@ -1425,32 +1980,27 @@ async def generate_final_report_advanced(
     # API key validation
     tier, allowed_tools = validate_api_key_and_tool("generate_final_report_advanced")
 
+    # Bound payload size before parsing or walking it
+    _assert_payload_limits("program_research", program_research)
+
     # ═══════════════════════════════════════════════════════════════
     # TYPE COERCION: Handle MCP serialization issues
     # ═══════════════════════════════════════════════════════════════
-    import json
     if isinstance(program_research, str):
         try:
             program_research = json.loads(program_research)
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, RecursionError):
             raise ValueError(f"Invalid program_research format: {program_research}")
+        _assert_payload_limits("program_research", program_research)
     # ═══════════════════════════════════════════════════════════════
 
     # Extract data from selection token
-    selection_data = validate_token(selection_token, "selection")
+    selection_data = await validate_token(selection_token, "selection")
 
     return {
         "report_generated": True,
         "programs_analyzed": len(program_research),
-        "message": """Report ready for generation.
-
-INSTRUCTIONS:
-- Programs to analyze: {} programs
-- Each program: 200-400 words with Exa research findings
-- Output in user's language
-- DO NOT include tuition/timeline/costs
-- Focus on program characteristics and student fit
-        """.format(len(program_research))
+        "message": _ADVANCED_REPORT_MESSAGE.format(program_count=len(program_research))
     }
 
 
@@ -1460,8 +2010,7 @@ async def get_available_countries() -> str:
     # API key validation
     tier, allowed_tools = validate_api_key_and_tool("get_available_countries")
 
-    countries = _get_available_countries()
-    return "\n".join([f"{c['country']} ({c['count']} programs)" for c in countries])
+    return _get_available_countries_text()
 
 
 @mcp.tool
@@ -1470,46 +2019,21 @@ async def get_database_statistics() -> dict:
     # API key validation
     tier, allowed_tools = validate_api_key_and_tool("get_database_statistics")
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) as total FROM programs")
-    total = cursor.fetchone()["total"]
-    
-    cursor.execute("""
-        SELECT country_standardized as country, COUNT(*) as count
-        FROM programs
-        WHERE country_standardized IS NOT NULL
-        GROUP BY country_standardized
-        ORDER BY count DESC
-        LIMIT 10
-    """)
-    countries = [{"country": row["country"], "count": row["count"]} for row in cursor.fetchall()]
-    
-    cursor.execute("""
-        SELECT degree_type, COUNT(*) as count
-        FROM programs
-        WHERE degree_type IS NOT NULL
-        GROUP BY degree_type
-        ORDER BY count DESC
-    """)
-    degrees = [{"degree_type": row["degree_type"], "count": row["count"]} for row in cursor.fetchall()]
-    
-    conn.close()
-    
-    return {
-        "total_programs": total,
-        "top_countries": countries,
-        "degree_types": degrees
-    }
+    stats = _stats_cache.get("stats")
+    if stats is not None:
+        return stats
+
+    with closing(get_db_connection().cursor()) as cursor:
+        cursor.execute(_DATABASE_STATISTICS_SQL)
+        stats = json.loads(cursor.fetchone()["payload"])
+
+    _stats_cache["stats"] = stats
+    return stats
 
 
 @mcp.tool()
 async def _internal_track_usage() -> str:
     """Internal usage tracking. Returns empty string."""
-    import psycopg2
-    from fastmcp.server.dependencies import get_http_headers
-
     api_key = ""
     try:
         headers = get_http_headers()
@@ -1517,60 +2041,169 @@ async def _internal_track_usage() -> str:
         if auth_header.startswith("Bearer "):
             api_key = auth_header[7:]
     except:
-        api_key = os.getenv("SSE_API_KEY", "")
+        api_key = SSE_API_KEY
 
     if not api_key or not api_key.startswith("sk_"):
         return ""
 
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432"),
-            dbname=os.getenv("POSTGRES_DB", "offeri"),
-            user=os.getenv("POSTGRES_USER", "offeri_user"),
-            password=os.getenv("POSTGRES_PASSWORD", "")
-        )
-        cursor = conn.cursor()
-        now = datetime.utcnow()
-
-        # Get user_id from API key (skip tracking for shared keys where user_id is NULL)
-        cursor.execute("""
-            SELECT user_id
-            FROM api_keys
-            WHERE id = %s AND is_active = true
-        """, (api_key,))
-        result = cursor.fetchone()
-
-        if not result or not result[0]:  # Skip if no result or user_id is NULL (shared key)
-            conn.close()
-            return ""
-
-        user_id = result[0]
-        
-        # Use correct id format for ON CONFLICT to work
-        usage_id = f"{user_id}_{now.year}_{now.month}"
-
-        cursor.execute("""
-            INSERT INTO mcp_usage (id, user_id, year, month, usage_count, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, 1, NOW(), NOW())
-            ON CONFLICT (id)
-            DO UPDATE SET usage_count = mcp_usage.usage_count + 1, updated_at = NOW()
-        """, (usage_id, user_id, now.year, now.month))
-        
-        conn.commit()
-        conn.close()
-    except:
-        pass
-    
+    # Shared, inactive and unknown keys never produce a usage row
+    if _untracked_key_cache.get(api_key):
+        return ""
+
+    # Count in memory; the flusher writes the summed deltas once per window
+    global _usage_calls_dropped
+    if api_key not in _pending_usage and len(_pending_usage) >= USAGE_PENDING_MAX_KEYS:
+        _usage_calls_dropped += 1
+        return ""
+    _pending_usage[api_key] += 1
+    if len(_pending_usage) >= USAGE_FLUSH_MAX_KEYS and not _usage_breaker.is_open:
+        _usage_flush_now.set()
+    _ensure_usage_flusher()
+
     return ""
 
 
+def _ensure_usage_flusher() -> None:
+    """Internal: Start the usage flusher on the running event loop if it is not already running"""
+    global _usage_flusher_task
+    if _usage_flusher_task is None or _usage_flusher_task.done():
+        _usage_flusher_task = asyncio.create_task(_usage_flusher())
+
+
+async def _usage_flusher() -> None:
+    """Internal: Every USAGE_FLUSH_INTERVAL seconds, write buffered usage counts in one statement"""
+    global _pending_usage, _usage_calls_dropped, _usage_drops_reported
+    while True:
+        try:
+            await asyncio.wait_for(_usage_flush_now.wait(), timeout=USAGE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _usage_flush_now.clear()
+
+        # While the breaker is open, counts keep accumulating (up to USAGE_PENDING_MAX_KEYS)
+        if not _pending_usage or _usage_breaker.is_open:
+            continue
+        batch, _pending_usage = _pending_usage, Counter()
+        try:
+            # Blocking psycopg2 work runs off the event loop
+            await asyncio.to_thread(_flush_usage, batch)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError) as e:
+            _usage_breaker.record_failure(e)
+            _requeue_usage(batch)  # Billing counts: retry them in a later window
+        except psycopg2.Error as e:
+            _usage_calls_dropped += sum(batch.values())
+            logger.error(f"Usage flush failed: {e}")
+        else:
+            _usage_breaker.record_success()
+
+        if _usage_calls_dropped != _usage_drops_reported:
+            logger.warning(f"Usage tracking: {_usage_calls_dropped} calls dropped so far")
+            _usage_drops_reported = _usage_calls_dropped
+
+async def _drain_usage() -> None:
+    """Internal: Final usage flush at shutdown; counts that still cannot be written are recorded as dropped"""
+    global _pending_usage, _usage_calls_dropped
+    task = _usage_flusher_task
+    if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    if not _pending_usage:
+        return
+    batch, _pending_usage = _pending_usage, Counter()
+    try:
+        # One last attempt even if the breaker is open: there is no later window
+        await asyncio.to_thread(_flush_usage, batch)
+    except psycopg2.Error as e:
+        _usage_calls_dropped += sum(batch.values())
+        logger.error(f"Usage flush at shutdown failed, {_usage_calls_dropped} calls dropped in total: {e}")
+
+def _requeue_usage(batch: Counter) -> None:
+    """Internal: Merge an unwritten batch back into the buffer, dropping keys beyond the cap"""
+    global _usage_calls_dropped
+    for api_key, n in batch.items():
+        if api_key in _pending_usage or len(_pending_usage) < USAGE_PENDING_MAX_KEYS:
+            _pending_usage[api_key] += n
+        else:
+            _usage_calls_dropped += n
+
+
+# Keys are resolved to users server-side; shared keys (user_id NULL) and unknown keys
+# join no row. Calls are summed per user before the upsert, and the keys that could
+# not be attributed are returned.
+_PREPARE_FLUSH_USAGE_SQL = """
+    PREPARE flush_usage(text[], int[]) AS
+    WITH b AS (
+        SELECT * FROM unnest($1, $2) AS b(api_key, n)
+    ), r AS (
+        SELECT b.api_key, b.n, k.user_id
+        FROM b
+        LEFT JOIN api_keys k ON k.id = b.api_key AND k.is_active = true AND k.user_id IS NOT NULL
+    ), m AS (
+        SELECT EXTRACT(YEAR FROM now() AT TIME ZONE 'UTC')::int AS year,
+               EXTRACT(MONTH FROM now() AT TIME ZONE 'UTC')::int AS month
+    ), upsert AS (
+        INSERT INTO mcp_usage (id, user_id, year, month, usage_count, created_at, updated_at)
+        SELECT r.user_id || '_' || m.year || '_' || m.month, r.user_id, m.year, m.month, SUM(r.n), NOW(), NOW()
+        FROM r, m
+        WHERE r.user_id IS NOT NULL
+        GROUP BY r.user_id, m.year, m.month
+        ON CONFLICT (id)
+        DO UPDATE SET usage_count = mcp_usage.usage_count + EXCLUDED.usage_count, updated_at = NOW()
+    )
+    SELECT api_key FROM r WHERE user_id IS NULL
+"""
+
+def _flush_usage(batch: Counter) -> None:
+    """Internal: Add a batch of per-key call counts to this month's mcp_usage rows.
+
+    Runs in a worker thread and raises psycopg2 errors; the flusher decides
+    whether the batch is retried or dropped.
+    """
+    api_keys = list(batch)
+    counts = [batch[k] for k in api_keys]
+    # Single-statement writes: autocommit avoids a separate COMMIT round trip
+    with _pg_connection(autocommit=True) as conn, conn.cursor() as cursor:
+        # Parsed and planned once per pooled connection, then reused by every flush
+        if "flush_usage" not in conn.prepared:
+            cursor.execute(_PREPARE_FLUSH_USAGE_SQL)
+            conn.prepared.add("flush_usage")
+        cursor.execute("EXECUTE flush_usage(%s, %s)", (api_keys, counts))
+        for (api_key,) in cursor.fetchall():
+            _untracked_key_cache[api_key] = True
+
+
 # ═══════════════════════════════════════════════════════════════
 # SERVER ENTRY POINT
 # ═══════════════════════════════════════════════════════════════
 
 if __name__ == "__main__":
+    # stderr only: stdout carries the JSON-RPC stream under the stdio transport
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if "--ensure-indexes" in sys.argv:
+        sys.exit(0 if _ensure_indexes() else 1)
+
+    _check_catalog_indexes()
+    _warm_catalog_caches()
+
     if "--http" in sys.argv:
-        mcp.run(transport='streamable-http', host='0.0.0.0', port=8080)
+        # uvloop speeds up socket dispatch for many small JSON-RPC messages
+        loop_factory = None
+        if sys.platform != "win32":
+            try:
+                import uvloop
+                loop_factory = uvloop.new_event_loop
+            except ImportError:
+                pass  # Fall back to the default asyncio loop
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            try:
+                runner.run(mcp.run_async(transport='streamable-http', host='0.0.0.0', port=8080))
+            finally:
+                runner.run(_drain_usage())  # Buffered usage counts are billing data
     else:
-        mcp.run(transport='stdio')
+        try:
+            mcp.run(transport='stdio')
+        finally:
+            asyncio.run(_drain_usage())